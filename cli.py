@@ -1,16 +1,31 @@
 import os
+import queue
 import sys
 import time
 import threading
 import re
-from pymongo import MongoClient
+from bson import json_util
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+from cachetools import LRUCache
 from dotenv import load_dotenv
 from typing import Dict, Any, Optional
 from datetime import datetime, timezone
+from src.db import (
+    EVENTS_CAPPED_SIZE, FAST_WRITE_CONCERN, MESSAGE_INDEXES, MONGO_URI, events_collection_name, sync_client,
+)
+from src.session_lookup import SessionResolver
 
 # --- Configuration & Setup ---
 load_dotenv()
-MONGO_URI = os.getenv("MONGO_URI")
+# "stream" watches the messages collection; "tail" reads the chat's small capped
+# events collection, which stays cheap when many admins follow the same chat.
+# Tail mode needs the API running with CHAT_EVENTS_ENABLED=1.
+LISTEN_MODE = os.getenv("CHAT_LISTEN_MODE", "stream")
+_STDOUT_LOCK = threading.Lock()
+# Formatted incoming messages, handed from the listener to the printer thread
+_OUTPUT_QUEUE = queue.SimpleQueue()
+RESUME_TOKEN_DIR = os.getenv("CLI_RESUME_DIR", os.path.join(os.path.expanduser("~"), ".chat_cli"))
 
 class Colors:
     USER, BOT, ADMIN, SYSTEM, RESET = '\033[94m', '\033[92m', '\033[93m', '\033[95m', '\033[0m'
@@ -22,7 +37,7 @@ def connect_to_db():
         print(f"{Colors.SYSTEM}Error: MONGO_URI not found. Exiting.{Colors.RESET}")
         sys.exit(1)
     try:
-        client = MongoClient(MONGO_URI)
+        client = sync_client()
         client.admin.command('ping')
         print(f"{Colors.SYSTEM}Successfully connected to MongoDB.{Colors.RESET}")
         return client.mobileauth, client.chats
@@ -33,98 +48,244 @@ def connect_to_db():
 auth_db, chats_db = connect_to_db()
 users_collection = auth_db.users
 sessions_collection = auth_db.sessions
+resolve_user = SessionResolver(users_collection, sessions_collection, LRUCache(maxsize=1024))
+messages_collection = chats_db.messages
+
+# Fields format_message needs; everything else stays on the server.
+MESSAGE_PROJECTION = {"sender": 1, "timestamp": 1, "text": 1}
 
 # --- Core Functions ---
 
-def find_user_by_session(session_id: str) -> Optional[Dict[str, Any]]:
-    """Finds a user document from the auth_db based on a session ID."""
-    user = None
-    if session_id.startswith('user_'):
-        user = users_collection.find_one({"clerkSessionId": session_id})
-    else:
-        session_record = sessions_collection.find_one({"sessionId": session_id, "verified": True})
-        if session_record:
-            mobile_number = session_record.get("mobileNumber")
-            user = users_collection.find_one({"mobileNumber": mobile_number})
-    return user
+def ensure_chat_collections(user_id):
+    """Indexes the messages collection and creates the chat's capped events collection."""
+    for keys in MESSAGE_INDEXES:
+        messages_collection.create_index(keys)
+    if LISTEN_MODE != "tail":
+        return
+    try:
+        # One marker per message written to this chat, for tailing listeners
+        chats_db.create_collection(events_collection_name(user_id), capped=True, size=EVENTS_CAPPED_SIZE)
+    except CollectionInvalid:
+        pass  # Already exists
+
+def events_collection(user_id):
+    return chats_db.get_collection(events_collection_name(user_id), write_concern=FAST_WRITE_CONCERN)
+
+_COLOR_MAP = {'USER': Colors.USER, 'BOT': Colors.BOT, 'ADMIN': Colors.ADMIN}
+_IMG_PREFIX = "https://i.ibb.co/"
+_TS_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 def format_message(msg: Dict[str, Any]):
     sender = msg.get('sender', 'system').upper()
-    color_map = {'USER': Colors.USER, 'BOT': Colors.BOT, 'ADMIN': Colors.ADMIN}
-    color = color_map.get(sender, Colors.SYSTEM)
-    timestamp = msg['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
+    color = _COLOR_MAP.get(sender, Colors.SYSTEM)
+    timestamp = msg['timestamp'].strftime(_TS_FORMAT)
     text = msg.get('text', '')
 
-    if text.startswith("https://i.ibb.co/"):
+    if text.startswith(_IMG_PREFIX):
         return f"{color}[{timestamp}] {sender}:{Colors.RESET} {Colors.IMAGE}[IMAGE SENT]: {text}{Colors.RESET}"
     return f"{color}[{timestamp}] {sender}:{Colors.RESET} {text}"
 
-def display_chat_history(chat_collection):
-    messages = list(chat_collection.find().sort("timestamp", 1))
-    if not messages:
+def display_chat_history(messages_collection, user_id):
+    cursor = (
+        messages_collection.find({"userId": user_id}, MESSAGE_PROJECTION)
+        .sort([("userId", 1), ("timestamp", 1), ("_id", 1)])
+        .batch_size(500)
+    )
+    lines = [format_message(msg) for msg in cursor]
+    if not lines:
         print(f"{Colors.SYSTEM}No chat history found for this user.{Colors.RESET}")
         return False
-    for msg in messages:
-        print(format_message(msg))
+    with _STDOUT_LOCK:
+        sys.stdout.write("\n".join(lines))
+        sys.stdout.write("\n")
     print(f"{Colors.SYSTEM}--- End of History ---{Colors.RESET}\n")
     return True
 
-def listen_for_new_messages(chat_collection, stop_event: threading.Event):
-    last_message = list(chat_collection.find().sort("timestamp", -1).limit(1))
-    last_timestamp = last_message[0]['timestamp'] if last_message else None
+def print_incoming(msg: Dict[str, Any]):
+    _OUTPUT_QUEUE.put(format_message(msg))
+
+def run_printer(stop_event: threading.Event):
+    """Writes queued messages in small batches so a slow terminal never stalls the listener."""
     while not stop_event.is_set():
+        batch = []
         try:
-            query = {"sender": {"$ne": "admin"}}
-            if last_timestamp:
-                query["timestamp"] = {"$gt": last_timestamp}
-            new_messages = list(chat_collection.find(query).sort("timestamp", 1))
+            # Block for the first message, then take whatever else is already queued
+            batch.append(_OUTPUT_QUEUE.get(timeout=0.5))
+            while len(batch) < 32:
+                batch.append(_OUTPUT_QUEUE.get_nowait())
+        except queue.Empty:
+            pass
+        if batch:
+            with _STDOUT_LOCK:
+                sys.stdout.write('\r' + ' ' * 80 + '\r')
+                sys.stdout.write("\n".join(batch) + "\n")
+                sys.stdout.write(f"{Colors.ADMIN}Admin> {Colors.RESET}")
+                sys.stdout.flush()
+
+def _resume_token_path(user_id) -> str:
+    return os.path.join(RESUME_TOKEN_DIR, f"chat_{user_id}.resume")
+
+def load_resume_token(user_id) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_resume_token_path(user_id)) as f:
+            return json_util.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def save_resume_token(user_id, token: Optional[Dict[str, Any]]):
+    path = _resume_token_path(user_id)
+    try:
+        if token is None:
+            os.remove(path)
+            return
+        os.makedirs(RESUME_TOKEN_DIR, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(json_util.dumps(token))
+    except OSError:
+        pass
+
+def _after(last_seen, ts_field: str, id_field: str) -> Dict[str, Any]:
+    """Matches documents strictly after last_seen, a (timestamp, _id) pair; messages can share a timestamp."""
+    if last_seen is None:
+        return {}
+    ts, oid = last_seen
+    return {"$or": [{ts_field: {"$gt": ts}}, {ts_field: ts, id_field: {"$gt": oid}}]}
+
+def watch_messages(messages_collection, user_id, stop_event: threading.Event, last_seen):
+    """Blocks on a change stream and prints messages as the server pushes them.
+
+    Raises OperationFailure if the deployment doesn't support change streams.
+    """
+    pipeline = [{"$match": {
+        "operationType": "insert",
+        "fullDocument.userId": user_id,
+        "fullDocument.sender": {"$ne": "admin"},
+    }}]
+    resume_token = load_resume_token(user_id)
+    while not stop_event.is_set():
+        try:
+            with messages_collection.watch(pipeline, full_document="updateLookup", resume_after=resume_token,
+                                           max_await_time_ms=500, batch_size=100) as stream:
+                while not stop_event.is_set() and stream.alive:
+                    change = stream.try_next()
+                    if change is None:
+                        continue
+                    # Inserts carry the whole message; never re-query it
+                    msg = change["fullDocument"]
+                    # A resumed stream can replay messages already shown in the history.
+                    key = (msg['timestamp'], msg['_id'])
+                    if last_seen is None or key > last_seen:
+                        print_incoming(msg)
+                        last_seen = key
+                    resume_token = stream.resume_token
+                    save_resume_token(user_id, resume_token)
+        except OperationFailure:
+            if resume_token is None:
+                raise
+            # The saved token fell off the oplog; start from now instead.
+            resume_token = None
+            save_resume_token(user_id, None)
+        except PyMongoError as e:
+            print(f"\n{Colors.SYSTEM}Error watching messages: {e}{Colors.RESET}")
+            time.sleep(5)
+
+def poll_messages(messages_collection, user_id, stop_event: threading.Event, last_seen):
+    while not stop_event.is_set():
+        try:
+            query = {"userId": user_id, "sender": {"$ne": "admin"}, **_after(last_seen, "timestamp", "_id")}
+            new_messages = list(
+                messages_collection.find(query, MESSAGE_PROJECTION).sort([("timestamp", 1), ("_id", 1)])
+            )
             if new_messages:
                 for msg in new_messages:
-                    with threading.Lock():
-                        sys.stdout.write('\r' + ' ' * 80 + '\r') 
-                        print(format_message(msg))
-                        sys.stdout.write(f"{Colors.ADMIN}Admin> {Colors.RESET}")
-                        sys.stdout.flush()
-                    last_timestamp = msg['timestamp']
+                    print_incoming(msg)
+                    last_seen = (msg['timestamp'], msg['_id'])
             time.sleep(1)
         except Exception as e:
             print(f"\n{Colors.SYSTEM}Error polling messages: {e}{Colors.RESET}")
             time.sleep(5)
 
-def send_admin_message(chat_collection, text: str):
-    message_doc = {"text": text, "sender": "admin", "timestamp": datetime.now(timezone.utc)}
-    chat_collection.insert_one(message_doc)
+def tail_events(messages_collection, user_id, stop_event: threading.Event, last_seen):
+    """Follows the chat's capped events collection with a tailable-await cursor."""
+    while not stop_event.is_set():
+        try:
+            query = {"sender": {"$ne": "admin"}, **_after(last_seen, "ts", "mid")}
+            cursor = events_collection(user_id).find(query, cursor_type=CursorType.TAILABLE_AWAIT).max_await_time_ms(1000)
+            while cursor.alive and not stop_event.is_set():
+                for evt in cursor:
+                    if "text" in evt:
+                        msg = {"sender": evt["sender"], "text": evt["text"], "timestamp": evt["ts"]}
+                    else:
+                        # Marker written before events carried the message text
+                        msg = messages_collection.find_one({"_id": evt["mid"]}, MESSAGE_PROJECTION)
+                    if msg:
+                        print_incoming(msg)
+                    last_seen = (evt["ts"], evt["mid"])
+            # A tailable cursor dies straight away on an empty collection.
+            time.sleep(1)
+        except PyMongoError as e:
+            print(f"\n{Colors.SYSTEM}Error tailing messages: {e}{Colors.RESET}")
+            time.sleep(5)
+
+def listen_for_new_messages(messages_collection, user_id, stop_event: threading.Event):
+    doc = messages_collection.find_one(
+        {"userId": user_id}, sort=[("timestamp", -1), ("_id", -1)], projection={"timestamp": 1}
+    )
+    # Newest message already shown in the history, as (timestamp, _id)
+    last_seen = (doc["timestamp"], doc["_id"]) if doc else None
+    if LISTEN_MODE == "tail":
+        tail_events(messages_collection, user_id, stop_event, last_seen)
+        return
+    try:
+        watch_messages(messages_collection, user_id, stop_event, last_seen)
+    except OperationFailure:
+        # Change streams need a replica set; fall back to polling on standalone servers.
+        poll_messages(messages_collection, user_id, stop_event, last_seen)
+
+def send_admin_message(messages_collection, user_id, text: str):
+    now = datetime.now(timezone.utc)
+    message_doc = {"userId": user_id, "text": text, "sender": "admin", "timestamp": now}
+    result = messages_collection.insert_one(message_doc)
+    if LISTEN_MODE == "tail":
+        events_collection(user_id).insert_one(
+            {"mid": result.inserted_id, "sender": "admin", "text": text, "ts": now}
+        )
 
 # --- Main Execution ---
 def main():
     try:
         session_id = sys.argv[1] if len(sys.argv) > 1 else input("Enter user's session ID: ")
         
-        user = find_user_by_session(session_id)
+        user = resolve_user(session_id)
         if not user:
             print(f"{Colors.SYSTEM}Error: No user found for session ID '{session_id}'.{Colors.RESET}")
             return
 
         user_id = user['_id']
         user_name = f"{user.get('firstName', 'N/A')} {user.get('lastName', '')}".strip()
-        chat_collection = chats_db[f"chat_{user_id}"]
+        ensure_chat_collections(user_id)
 
         print(f"\n{Colors.SYSTEM}Connecting to chat with {user_name} (ID: {user_id})...{Colors.RESET}")
         
-        display_chat_history(chat_collection)
+        display_chat_history(messages_collection, user_id)
         print(f"{Colors.SYSTEM}Successfully connected. Type 'exit' to quit.{Colors.RESET}")
 
         stop_event = threading.Event()
-        listener_thread = threading.Thread(target=listen_for_new_messages, args=(chat_collection, stop_event))
+        listener_thread = threading.Thread(target=listen_for_new_messages, args=(messages_collection, user_id, stop_event))
         listener_thread.daemon = True
         listener_thread.start()
+        printer_thread = threading.Thread(target=run_printer, args=(stop_event,), daemon=True)
+        printer_thread.start()
 
         while True:
-            admin_input = input(f"{Colors.ADMIN}Admin> {Colors.RESET}")
+            with _STDOUT_LOCK:
+                sys.stdout.write(f"{Colors.ADMIN}Admin> {Colors.RESET}")
+                sys.stdout.flush()
+            admin_input = input()
             if admin_input.lower() == 'exit':
                 break
             if admin_input.strip():
-                send_admin_message(chat_collection, admin_input)
+                send_admin_message(messages_collection, user_id, admin_input)
     except (KeyboardInterrupt, EOFError):
         print(f"\n{Colors.SYSTEM}Disconnecting...{Colors.RESET}")
     finally:
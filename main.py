@@ -1,10 +1,64 @@
 # main.py or app.py
-from fastapi import FastAPI
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from src.auth import router as auth_router
-from src.chat import router as chat_router
+from fastapi.responses import ORJSONResponse
+from pymongo.errors import (
+    DuplicateKeyError, NetworkTimeout, PyMongoError, ServerSelectionTimeoutError, WaitQueueTimeoutError
+)
+from src.auth import router as auth_router, ensure_indexes
+from src.chat import router as chat_router, ensure_chat_collections
+from src.api_clients import index_client, redis
+from src.http_client import http_client
+from src.logging_setup import log_listener
+
+logger = logging.getLogger("app")
+
+async def build_indexes():
+    """Creates indexes in the background; a slow or failed build never blocks serving."""
+    # Index builds get their own client so they aren't cut off by the request pool's socket timeout
+    mongo_admin = index_client()
+    try:
+        for ensure in (ensure_indexes, ensure_chat_collections):
+            try:
+                await ensure(mongo_admin)
+            except PyMongoError:
+                logger.exception("%s failed; serving without those indexes", ensure.__name__)
+    finally:
+        mongo_admin.close()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener.start()
+    index_task = asyncio.create_task(build_indexes())
+    yield
+    index_task.cancel()
+    await http_client.aclose()
+    if redis is not None:
+        await redis.aclose()
+    log_listener.stop()  # Flushes queued records
+
+app = FastAPI(title="Mobile Auth API", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Mongo unreachable or overloaded: tell clients to retry rather than hang or 500
+@app.exception_handler(ServerSelectionTimeoutError)
+@app.exception_handler(NetworkTimeout)
+@app.exception_handler(WaitQueueTimeoutError)
+async def database_unavailable_handler(request: Request, exc: Exception):
+    return ORJSONResponse(status_code=503, content={"detail": "Database temporarily unavailable"})
+
+# e.g. a mobile number or email already taken by another user
+@app.exception_handler(DuplicateKeyError)
+async def duplicate_key_handler(request: Request, exc: DuplicateKeyError):
+    return ORJSONResponse(status_code=409, content={"detail": "Record already exists"})
 
-app = FastAPI(title="Mobile Auth API")
+# Any other database failure; details go to the log, not the client
+@app.exception_handler(PyMongoError)
+async def database_error_handler(request: Request, exc: PyMongoError):
+    logger.error("Database error on %s %s", request.method, request.url.path, exc_info=exc)
+    return ORJSONResponse(status_code=500, content={"detail": "Internal server error"})
 
 # Add CORS middleware
 app.add_middleware(
@@ -0,0 +1,65 @@
+import sys
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError
+from src.db import MONGO_URI, sync_client
+
+# Moves legacy per-user chat_<user_id> collections into the shared chats.messages
+# collection. Safe to re-run: messages keep their _id, so copies are skipped.
+# Usage: python migrate_chats.py [--drop]
+
+BATCH_SIZE = 1000
+
+def insert_batch(messages_collection, batch):
+    try:
+        messages_collection.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        # Ignore messages copied by an earlier run; anything else is a real failure
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+            raise
+
+def migrate_collection(chats_db, users_collection, name: str) -> int:
+    user_id = ObjectId(name[len("chat_"):])
+    moved = 0
+    has_user_messages = False
+    batch = []
+    for msg in chats_db[name].find().sort("timestamp", 1):
+        msg["userId"] = user_id
+        has_user_messages = has_user_messages or msg.get("sender") == "user"
+        batch.append(msg)
+        if len(batch) >= BATCH_SIZE:
+            insert_batch(chats_db.messages, batch)
+            moved += len(batch)
+            batch = []
+    if batch:
+        insert_batch(chats_db.messages, batch)
+        moved += len(batch)
+
+    # These users have already seen the bot welcome
+    if has_user_messages:
+        users_collection.update_one({"_id": user_id}, {"$set": {"welcomeSent": True}})
+    return moved
+
+def main():
+    if not MONGO_URI:
+        print("Error: MONGO_URI not found. Exiting.")
+        sys.exit(1)
+
+    drop = "--drop" in sys.argv[1:]
+    client = sync_client()
+    chats_db = client.chats
+    users_collection = client.mobileauth.users
+
+    for name in sorted(chats_db.list_collection_names(filter={"name": {"$regex": "^chat_"}})):
+        try:
+            moved = migrate_collection(chats_db, users_collection, name)
+        except InvalidId:
+            continue  # Not a per-user chat collection (e.g. chat_<id>_events)
+        print(f"{name}: {moved} messages")
+        if drop:
+            chats_db.drop_collection(name)
+
+    print("Migration complete.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import sys
+from pydantic import EmailStr, TypeAdapter, ValidationError
+from pymongo.errors import DuplicateKeyError
+from src.db import MONGO_URI, sync_client
+
+# Rewrites stored user emails into the form EmailStr produces (lowercased domain), which
+# /save-google-user-details matches on exactly. Run before deploying that change so existing
+# mixed-case accounts are found instead of duplicated. Safe to re-run.
+# Usage: python normalize_emails.py
+
+EMAIL_ADAPTER = TypeAdapter(EmailStr)
+
+def main():
+    if not MONGO_URI:
+        print("Error: MONGO_URI not found. Exiting.")
+        sys.exit(1)
+
+    users_collection = sync_client().mobileauth.users
+    updated = 0
+    for user in users_collection.find({"email": {"$type": "string"}}, {"email": 1}):
+        try:
+            normalized = EMAIL_ADAPTER.validate_python(user["email"])
+        except ValidationError:
+            print(f"{user['_id']}: skipped invalid email {user['email']!r}")
+            continue
+        if normalized == user["email"]:
+            continue
+        try:
+            users_collection.update_one({"_id": user["_id"]}, {"$set": {"email": normalized}})
+        except DuplicateKeyError:
+            # Another account already holds the normalized address; these need merging by hand
+            print(f"{user['_id']}: {user['email']!r} conflicts with an existing {normalized!r}")
+            continue
+        updated += 1
+
+    print(f"Normalized {updated} emails.")
+
+if __name__ == "__main__":
+    main()
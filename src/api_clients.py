@@ -0,0 +1,29 @@
+# backend/src/api_clients.py
+
+import os
+from motor.motor_asyncio import AsyncIOMotorClient
+from redis.asyncio import Redis
+from .db import CLIENT_OPTIONS, MONGO_URI
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+# One pool per API process, shared by auth.py and chat.py and multiplexed
+# across in-flight requests
+client = AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=50,
+    minPoolSize=5,
+    waitQueueTimeoutMS=2000,
+    socketTimeoutMS=5000,
+    **CLIENT_OPTIONS,
+)
+
+def index_client() -> AsyncIOMotorClient:
+    """
+    Short-lived client for startup index builds, which can outlast the request pool's 5 s socket timeout
+    """
+    return AsyncIOMotorClient(MONGO_URI, maxPoolSize=1, **CLIENT_OPTIONS)
+
+# Optional shared cache for session lookups; None when REDIS_URL isn't set.
+# Short timeouts so an unreachable Redis falls through to Mongo instead of hanging requests.
+redis = Redis.from_url(REDIS_URL, socket_connect_timeout=1.0, socket_timeout=0.5) if REDIS_URL else None
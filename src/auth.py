@@ -1,40 +1,95 @@
 # backend/src/auth.py
 
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, EmailStr, StrictBool, constr
+import asyncio
+import httpx
+import logging
 import os
-import requests
-from pymongo import MongoClient
+from cachetools import TTLCache
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Optional, Dict, Any
+from .api_clients import client, redis
+from .db import FAST_WRITE_CONCERN
+from .http_client import http_client
+from . import logging_setup  # noqa: F401  (queues the auth/chat loggers)
+from .session_lookup import AsyncSessionResolver
 
 load_dotenv()
 
 API_KEY = os.getenv("TWO_FACTOR_API_KEY")
-MONGO_URI = os.getenv("MONGO_URI")
 
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
+# 2factor.in endpoints, formatted with the per-request parts; calls go over the shared keep-alive client
+TWO_FACTOR_SEND_URL = f"https://2factor.in/API/V1/{API_KEY}/SMS/{{mobile}}/AUTOGEN3"
+TWO_FACTOR_VERIFY_URL = f"https://2factor.in/API/V1/{API_KEY}/SMS/VERIFY/{{session_id}}/{{otp}}"
+TWO_FACTOR_TIMEOUT = httpx.Timeout(5.0, connect=2.0)
+
+logger = logging.getLogger("auth")
+
 db = client.mobileauth  # database
 sessions_collection = db.sessions  # collection for sessionId storage
 users_collection = db.users  # collection for user details
 preferences_collection = db.preferences
+# Default-preferences inserts are cheap to redo, so don't wait on the journal
+preferences_defaults_collection = preferences_collection.with_options(write_concern=FAST_WRITE_CONCERN)
+
+async def create_unique_index(collection, key: str, **kwargs):
+    """
+    Builds a unique index, logging instead of failing startup when existing
+    documents already hold duplicate values; those need merging by hand first.
+    """
+    try:
+        await collection.create_index(key, unique=True, **kwargs)
+    except OperationFailure as e:
+        logger.error("Unique index on %s.%s not created: %s", collection.name, key, e)
+
+async def ensure_indexes(mongo_client):
+    """
+    Creates the indexes behind the session and user lookups every endpoint makes.
+    """
+    auth_db = mongo_client.mobileauth
+    await create_unique_index(auth_db.sessions, "sessionId")
+    # send_otp upserts sessions by mobile number
+    await auth_db.sessions.create_index("mobileNumber")
+    # Google users store mobileNumber as null, so only index real numbers
+    await create_unique_index(
+        auth_db.users,
+        "mobileNumber",
+        partialFilterExpression={"mobileNumber": {"$type": "string"}},
+    )
+    await auth_db.users.create_index("clerkSessionId", sparse=True)
+    # Mobile users may save a null email, so only string emails must be unique
+    await create_unique_index(
+        auth_db.users,
+        "email",
+        partialFilterExpression={"email": {"$type": "string"}},
+    )
+    await auth_db.preferences.create_index([("sessionId", 1)], sparse=True)
+    await auth_db.preferences.create_index([("clerkSessionId", 1)], sparse=True)
 
 router = APIRouter()
 
-# Default preferences that match the frontend
-DEFAULT_PREFERENCES = {
-    "pushPromotions": True,
-    "pushProductUpdates": True,
-    "pushAccountActivity": True,
-    "emailPromotions": True,
-    "emailProductUpdates": True,
-    "emailNewsletters": True,
-    "emailAccountActivity": True,
-    "smsAccountActivity": True,
-    "whatsappPromotions": True,
-}
+# Preferences that match the frontend; every flag defaults to on
+class PreferencesModel(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    pushPromotions: StrictBool = True
+    pushProductUpdates: StrictBool = True
+    pushAccountActivity: StrictBool = True
+    emailPromotions: StrictBool = True
+    emailProductUpdates: StrictBool = True
+    emailNewsletters: StrictBool = True
+    emailAccountActivity: StrictBool = True
+    smsAccountActivity: StrictBool = True
+    whatsappPromotions: StrictBool = True
+
+DEFAULT_PREFERENCES = PreferencesModel().model_dump()
+
+NonEmptyStr = constr(min_length=1)
+MobileNumber = constr(pattern=r"^\d{10}$")
 
 
 class OTPRequest(BaseModel):
@@ -56,141 +111,135 @@ class UserDetailsRequest(BaseModel):
 
 # Add the Google user details model
 class GoogleUserDetailsRequest(BaseModel):
-    clerkSessionId: str  # Use Clerk's session ID
-    email: str
-    firstName: str
+    clerkSessionId: NonEmptyStr  # Use Clerk's session ID
+    email: EmailStr
+    firstName: NonEmptyStr
     lastName: Optional[str] = None
 
 class AddMobileToGoogleUserRequest(BaseModel):
-    clerkSessionId: str
-    mobileNumber: str
+    clerkSessionId: NonEmptyStr
+    mobileNumber: MobileNumber
 
 class UpdatePreferencesRequest(BaseModel):
     sessionId: str
-    preferences: Dict[str, bool]
+    preferences: PreferencesModel
 
 class UpdateUserDetailsRequest(BaseModel):
     sessionId: str
     firstName: Optional[str] = None
     lastName: Optional[str] = None
     email: Optional[str] = None
-def get_user_by_session(session_id: str):
-    """
-    Helper function to get user by session ID (handles both mobile and clerk sessions)
-    """
-    if session_id.startswith('user_'):
-        # Clerk session ID
-        user = users_collection.find_one({"clerkSessionId": session_id})
-    else:
-        # Mobile session ID - first find the session, then the user
-        session_record = sessions_collection.find_one({
-            "sessionId": session_id,
-            "verified": True
-        })
-        if not session_record:
-            return None
-        
-        mobile_number = session_record.get("mobileNumber")
-        user = users_collection.find_one({"mobileNumber": mobile_number})
-    
-    return user
 
+# Only the fields handlers need once a session has been resolved to a user
+SESSION_USER_PROJECTION = {"_id": 1, "authProvider": 1, "mobileNumber": 1, "clerkSessionId": 1}
 
-@router.post("/send-otp")
-def send_otp(request: OTPRequest):
-    url = f"https://2factor.in/API/V1/{API_KEY}/SMS/{request.mobileNumber}/AUTOGEN3"
-    resp = requests.get(url)
+# Session ID -> user lookups, cached briefly so reverified sessions are picked up.
+# Invalidation can't reach other workers' local caches, so with Redis sharing hits
+# the local TTL bounds how long a replaced session keeps resolving there.
+LOCAL_SESSION_TTL = 5 if redis is not None else 60
+resolve_user = AsyncSessionResolver(
+    users_collection,
+    sessions_collection,
+    TTLCache(maxsize=10_000, ttl=LOCAL_SESSION_TTL),
+    SESSION_USER_PROJECTION,
+    redis=redis,
+)
+
+
+async def two_factor_get(url: str) -> Dict[str, Any]:
+    """GETs a 2factor.in endpoint and returns its JSON body."""
+    try:
+        resp = await http_client.get(url, timeout=TWO_FACTOR_TIMEOUT)
+    except httpx.HTTPError:
+        raise HTTPException(status_code=502, detail="Could not reach 2factor.in")
 
     try:
-        data = resp.json()
+        return resp.json()
     except Exception:
         raise HTTPException(status_code=500, detail="Invalid response from 2factor.in")
 
+
+@router.post("/send-otp")
+async def send_otp(request: OTPRequest):
+    data = await two_factor_get(TWO_FACTOR_SEND_URL.format(mobile=request.mobileNumber))
+
     if data.get("Status") != "Success":
         raise HTTPException(status_code=400, detail=data.get("Details", "Failed to send OTP"))
 
     session_id = data["Details"]
+    now = datetime.now(timezone.utc)
 
-    # Store sessionId with mobileNumber in MongoDB (upsert)
-    sessions_collection.update_one(
+    # Store sessionId with mobileNumber in MongoDB (upsert), keeping the sessionId it replaces
+    previous = await sessions_collection.find_one_and_update(
         {"mobileNumber": request.mobileNumber},
         {
             "$set": {
                 "sessionId": session_id, 
                 "createdAt": data.get("CreatedOn"),
                 "verified": False,
-                "updatedAt": datetime.utcnow()
+                "updatedAt": now
             }
         },
+        projection={"sessionId": 1},
         upsert=True,
+        return_document=ReturnDocument.BEFORE,
     )
 
+    # The replaced session must stop resolving from the session cache
+    if previous and previous.get("sessionId") != session_id:
+        await resolve_user.invalidate(previous["sessionId"])
+
     return {"sessionId": session_id}
 
 @router.post("/verify-otp")
-def verify_otp(request: OTPVerifyRequest):
-    # Check sessionId matches session stored in DB
-    record = sessions_collection.find_one({"sessionId": request.sessionId})
-
+async def verify_otp(request: OTPVerifyRequest):
+    # Check sessionId matches session stored in DB before spending a 2factor.in call on it
+    record = await sessions_collection.find_one({"sessionId": request.sessionId}, {"mobileNumber": 1})
     if not record:
         raise HTTPException(status_code=400, detail="Invalid or expired sessionId")
 
-    url = f"https://2factor.in/API/V1/{API_KEY}/SMS/VERIFY/{request.sessionId}/{request.otp}"
-    resp = requests.get(url)
-
-    try:
-        data = resp.json()
-    except Exception:
-        raise HTTPException(status_code=500, detail="Invalid response from 2factor.in")
-
+    data = await two_factor_get(TWO_FACTOR_VERIFY_URL.format(session_id=request.sessionId, otp=request.otp))
     if data.get("Status") != "Success":
         raise HTTPException(status_code=400, detail=data.get("Details", "OTP verification failed"))
 
-    # Mark session verified, add timestamp, etc.
-    sessions_collection.update_one(
-        {"sessionId": request.sessionId},
-        {
-            "$set": {
-                "verified": True, 
-                "verifiedAt": data.get("VerifiedOn"),
-                "updatedAt": datetime.utcnow()
-            }
-        },
+    # Mark session verified and check if user details already exist for this mobile number
+    existing_user, _ = await asyncio.gather(
+        users_collection.find_one({"mobileNumber": record.get("mobileNumber")}, {"_id": 1}),
+        sessions_collection.update_one(
+            {"sessionId": request.sessionId},
+            {
+                "$set": {
+                    "verified": True, 
+                    "verifiedAt": data.get("VerifiedOn"),
+                    "updatedAt": datetime.now(timezone.utc)
+                }
+            },
+        ),
     )
 
-    # Check if user details already exist for this mobile number
-    mobile_number = record.get("mobileNumber")
-    user_exists = users_collection.find_one({"mobileNumber": mobile_number}) is not None
+    await resolve_user.invalidate(request.sessionId)
 
-    return {"success": True, "userExists": user_exists}
+    return {"success": True, "userExists": existing_user is not None}
 
 @router.post("/validate-session")
-def validate_session(request: ValidateSessionRequest):
-    # Check if session exists and is verified
-    session_doc = sessions_collection.find_one({
-        "sessionId": request.sessionId, 
-        "verified": True
-    })
-    
-    if not session_doc:
+async def validate_session(request: ValidateSessionRequest):
+    # Only mobile sessions are validated here; Clerk IDs never were
+    if request.sessionId.startswith('user_'):
         return {"success": False}
-    
-    # Check if user details exist for this session's mobile number
-    mobile_number = session_doc.get("mobileNumber")
-    user_doc = users_collection.find_one({"mobileNumber": mobile_number})
-    
-    if user_doc:
-        return {"success": True}
-    
-    return {"success": False}
+
+    # Session must be verified and have user details for its mobile number
+    user = await resolve_user(request.sessionId)
+    return {"success": user is not None}
 
 @router.post("/save-user-details")
-def save_user_details(request: UserDetailsRequest):
-    # Validate session first
-    session_record = sessions_collection.find_one({
+async def save_user_details(request: UserDetailsRequest):
+    now = datetime.now(timezone.utc)
+
+    # Validate session
+    session_record = await sessions_collection.find_one({
         "sessionId": request.sessionId,
         "verified": True
-    })
+    }, {"mobileNumber": 1})
 
     if not session_record:
         raise HTTPException(status_code=400, detail="Invalid or unverified session")
@@ -199,58 +248,55 @@ def save_user_details(request: UserDetailsRequest):
     if session_record.get("mobileNumber") != request.mobileNumber:
         raise HTTPException(status_code=400, detail="Mobile number mismatch")
 
-    # Check if user already exists
-    existing_user = users_collection.find_one({"mobileNumber": request.mobileNumber})
-
     user_data = {
         "mobileNumber": request.mobileNumber,
         "firstName": request.firstName,
         "lastName": request.lastName,
         "email": request.email,
         "sessionId": request.sessionId,
-        "updatedAt": datetime.utcnow()
+        "updatedAt": now
     }
 
-    if existing_user:
-        # Update existing user
-        users_collection.update_one(
-            {"mobileNumber": request.mobileNumber},
-            {"$set": user_data}
+    # Create or update the user in one atomic write
+    result = await users_collection.update_one(
+        {"mobileNumber": request.mobileNumber},
+        {"$set": user_data, "$setOnInsert": {"createdAt": now}},
+        upsert=True
+    )
+    is_new_user = result.upserted_id is not None
+
+    # Update session with user completion flag
+    writes = [
+        sessions_collection.update_one(
+            {"sessionId": request.sessionId},
+            {
+                "$set": {
+                    "userDetailsCompleted": True,
+                    "updatedAt": now
+                }
+            }
         )
-        user_id = existing_user["_id"]
-    else:
-        # Create new user
-        user_data["createdAt"] = datetime.utcnow()
-        result = users_collection.insert_one(user_data)
-        user_id = result.inserted_id
+    ]
 
     # Create default preferences for new user
-    if not existing_user:
-        preferences_collection.insert_one({
-            "userId": user_id,
+    if is_new_user:
+        writes.append(preferences_defaults_collection.insert_one({
+            "userId": result.upserted_id,
             "sessionId": request.sessionId,
             "preferences": DEFAULT_PREFERENCES,
-            "createdAt": datetime.utcnow(),
-            "updatedAt": datetime.utcnow()
-        })
+            "createdAt": now,
+            "updatedAt": now
+        }))
 
-    # Update session with user completion flag
-    sessions_collection.update_one(
-        {"sessionId": request.sessionId},
-        {
-            "$set": {
-                "userDetailsCompleted": True,
-                "updatedAt": datetime.utcnow()
-            }
-        }
-    )
+    await asyncio.gather(*writes)
+    await resolve_user.invalidate(request.sessionId)
 
     return {"success": True}
 
 @router.get("/user-profile/{session_id}")
-def get_user_profile(session_id: str):
+async def get_user_profile(session_id: str):
     # Validate session
-    session_record = sessions_collection.find_one({
+    session_record = await sessions_collection.find_one({
         "sessionId": session_id,
         "verified": True
     })
@@ -260,9 +306,9 @@ def get_user_profile(session_id: str):
 
     # Get user details
     mobile_number = session_record.get("mobileNumber")
-    user_record = users_collection.find_one(
+    user_record = await users_collection.find_one(
         {"mobileNumber": mobile_number},
-        {"_id": 0, "sessionId": 0}  # Exclude sensitive fields
+        {"_id": 0, "sessionId": 0, "welcomeSent": 0}  # Exclude sensitive and chat-internal fields
     )
 
     if not user_record:
@@ -272,287 +318,214 @@ def get_user_profile(session_id: str):
 
 # Google OAuth endpoint
 @router.post("/save-google-user-details")
-def save_google_user_details(request: GoogleUserDetailsRequest):
+async def save_google_user_details(request: GoogleUserDetailsRequest):
     """
     Saves user details obtained from Google Sign-In via Clerk.
     Uses email as the primary identifier.
     """
-    try:
-        # --- Basic Validation ---
-        if not request.clerkSessionId:
-            raise HTTPException(status_code=400, detail="Clerk session ID is required")
-        
-        if not request.email:
-            raise HTTPException(status_code=400, detail="Email is required")
-        
-        if not request.firstName:
-            raise HTTPException(status_code=400, detail="First name is required")
-
-        print(f"Processing Google user: {request.email}")
-
-        # --- User Data Handling ---
-        # Use email as the unique identifier for Google users
-        existing_user = users_collection.find_one({"email": request.email})
-
-        # Prepare user data to save/update
-        user_data_to_set = {
-            "email": request.email,
-            "firstName": request.firstName,
-            "lastName": request.lastName,
+    logger.info("Processing Google user: %s", request.email)
+    now = datetime.now(timezone.utc)
+
+    # --- User Data Handling ---
+    # Use email as the unique identifier for Google users. EmailStr lowercases the domain, so
+    # stored emails must be in the same form (normalize_emails.py rewrites older ones).
+    user_data_to_set = {
+        "email": request.email,
+        "firstName": request.firstName,
+        "lastName": request.lastName,
+        "clerkSessionId": request.clerkSessionId,
+        "authProvider": "google",  # Track auth method
+        "updatedAt": now
+    }
+
+    user_data_to_set_on_insert = {
+        "createdAt": now,
+        "mobileNumber": None  # Explicitly set to None for Google users
+    }
+
+    # Create or update the user in one atomic write
+    result = await users_collection.update_one(
+        {"email": request.email},
+        {"$set": user_data_to_set, "$setOnInsert": user_data_to_set_on_insert},
+        upsert=True
+    )
+    is_new_user = result.upserted_id is not None
+
+    if is_new_user:
+        logger.info("Created new user: %s", request.email)
+
+        # Create default preferences for new Google user
+        await preferences_defaults_collection.insert_one({
+            "userId": result.upserted_id,
             "clerkSessionId": request.clerkSessionId,
-            "authProvider": "google",  # Track auth method
-            "updatedAt": datetime.utcnow()
-        }
-        
-        user_data_to_set_on_insert = {
-            "createdAt": datetime.utcnow(),
-            "mobileNumber": None  # Explicitly set to None for Google users
-        }
+            "preferences": DEFAULT_PREFERENCES,
+            "createdAt": now,
+            "updatedAt": now
+        })
+    else:
+        logger.info("Updated existing user: %s", request.email)
 
-        if existing_user:
-            # --- Update Existing User ---
-            result = users_collection.update_one(
-                {"email": request.email},
-                {"$set": user_data_to_set}
-            )
-            
-            if result.matched_count == 0:
-                raise HTTPException(status_code=500, detail="Failed to update user record")
-                
-            print(f"Updated existing user: {request.email}")
-            user_id = existing_user["_id"]
-
-        else:
-            # --- Create New User ---
-            new_user_data = {**user_data_to_set, **user_data_to_set_on_insert}
-            result = users_collection.insert_one(new_user_data)
-            
-            if not result.inserted_id:
-                raise HTTPException(status_code=500, detail="Failed to create user record")
-                
-            print(f"Created new user: {request.email}")
-            user_id = result.inserted_id
-
-            # Create default preferences for new Google user
-            preferences_collection.insert_one({
-                "userId": user_id,
-                "clerkSessionId": request.clerkSessionId,
-                "preferences": DEFAULT_PREFERENCES,
-                "createdAt": datetime.utcnow(),
-                "updatedAt": datetime.utcnow()
-            })
-
-        return {
-            "success": True, 
-            "message": "User details saved successfully",
-            "userExists": existing_user is not None
-        }
-        
-    except HTTPException:
-        # Re-raise HTTP exceptions as-is
-        raise
-    except Exception as e:
-        print(f"Error saving Google user details: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return {
+        "success": True, 
+        "message": "User details saved successfully",
+        "userExists": not is_new_user
+    }
 
 # Get user profile by Clerk session ID
 @router.get("/user-profile-clerk/{clerk_session_id}")
-def get_user_profile_by_clerk_session(clerk_session_id: str):
+async def get_user_profile_by_clerk_session(clerk_session_id: str):
     """
     Get user profile using Clerk session ID (for Google users)
     """
-    try:
-        # Find user by Clerk session ID
-        user_record = users_collection.find_one(
-            {"clerkSessionId": clerk_session_id},
-            {"_id": 0}  # Exclude MongoDB _id field
-        )
+    # Find user by Clerk session ID
+    user_record = await users_collection.find_one(
+        {"clerkSessionId": clerk_session_id},
+        {"_id": 0, "welcomeSent": 0}  # Exclude MongoDB _id and the chat-internal flag
+    )
 
-        if not user_record:
-            raise HTTPException(status_code=404, detail="User profile not found")
+    if not user_record:
+        raise HTTPException(status_code=404, detail="User profile not found")
 
-        return user_record
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Error getting user profile by Clerk session: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return user_record
 
 @router.post("/add-mobile-to-google-user")
-def add_mobile_to_google_user(request: AddMobileToGoogleUserRequest):
+async def add_mobile_to_google_user(request: AddMobileToGoogleUserRequest):
     """
     Adds mobile number to an existing Google user account.
     """
-    try:
-        # Validate inputs
-        if not request.clerkSessionId:
-            raise HTTPException(status_code=400, detail="Clerk session ID is required")
-        
-        if not request.mobileNumber:
-            raise HTTPException(status_code=400, detail="Mobile number is required")
-        
-        if len(request.mobileNumber) != 10:
-            raise HTTPException(status_code=400, detail="Mobile number must be 10 digits")
-
-        print(f"Adding mobile number to Google user with session: {request.clerkSessionId}")
-
-        # Find the user by Clerk session ID
-        existing_user = users_collection.find_one({"clerkSessionId": request.clerkSessionId})
-
-        if not existing_user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Update user with mobile number
-        result = users_collection.update_one(
-            {"clerkSessionId": request.clerkSessionId},
-            {
-                "$set": {
-                    "mobileNumber": request.mobileNumber,
-                    "updatedAt": datetime.utcnow()
-                }
+    logger.info("Adding mobile number to Google user with session: %s", request.clerkSessionId)
+
+    # Find the user by Clerk session ID
+    existing_user = await users_collection.find_one({"clerkSessionId": request.clerkSessionId})
+
+    if not existing_user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    # Update user with mobile number
+    result = await users_collection.update_one(
+        {"clerkSessionId": request.clerkSessionId},
+        {
+            "$set": {
+                "mobileNumber": request.mobileNumber,
+                "updatedAt": datetime.now(timezone.utc)
             }
-        )
-        
-        if result.matched_count == 0:
-            raise HTTPException(status_code=500, detail="Failed to update user record")
-            
-        print(f"Successfully added mobile number for user: {existing_user.get('email')}")
-
-        return {
-            "success": True, 
-            "message": "Mobile number added successfully"
         }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Error adding mobile number to Google user: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    )
+
+    if result.matched_count == 0:
+        raise HTTPException(status_code=500, detail="Failed to update user record")
+
+    await resolve_user.invalidate(request.clerkSessionId)
+
+    logger.info("Successfully added mobile number for user: %s", existing_user.get("email"))
+
+    return {
+        "success": True, 
+        "message": "Mobile number added successfully"
+    }
 
 # NEW ENDPOINTS FOR PREFERENCES
 
 @router.get("/get-preferences/{session_id}")
-def get_preferences(session_id: str):
+async def get_preferences(session_id: str):
     """
     Get user preferences by session ID (supports both mobile and Clerk sessions)
     """
-    try:
-        # Get user by session ID
-        user = get_user_by_session(session_id)
-        
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Find preferences for this user
-        if session_id.startswith('user_'):
-            # Clerk session
-            prefs_record = preferences_collection.find_one({"clerkSessionId": session_id})
-        else:
-            # Mobile session
-            prefs_record = preferences_collection.find_one({"sessionId": session_id})
-
-        if prefs_record:
-            return prefs_record["preferences"]
-        else:
-            # Return default preferences if none found
-            return DEFAULT_PREFERENCES
-            
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Error getting preferences: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    # Get user by session ID
+    user = await resolve_user(session_id)
+
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    # Find preferences for this user
+    if session_id.startswith('user_'):
+        # Clerk session
+        prefs_record = await preferences_collection.find_one({"clerkSessionId": session_id})
+    else:
+        # Mobile session
+        prefs_record = await preferences_collection.find_one({"sessionId": session_id})
+
+    if prefs_record:
+        return prefs_record["preferences"]
+    else:
+        # Return default preferences if none found
+        return DEFAULT_PREFERENCES
 
 @router.post("/update-preferences")
-def update_preferences(request: UpdatePreferencesRequest):
+async def update_preferences(request: UpdatePreferencesRequest):
     """
     Update user preferences
     """
-    try:
-        # Get user by session ID
-        user = get_user_by_session(request.sessionId)
-        
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Validate preferences structure
-        for key, value in request.preferences.items():
-            if not isinstance(value, bool):
-                raise HTTPException(status_code=400, detail=f"Preference '{key}' must be a boolean")
-
-        # Update or create preferences
-        if request.sessionId.startswith('user_'):
-            # Clerk session
-            filter_query = {"clerkSessionId": request.sessionId}
-            update_data = {
-                "userId": user["_id"],
-                "clerkSessionId": request.sessionId,
-                "preferences": request.preferences,
-                "updatedAt": datetime.utcnow()
-            }
-        else:
-            # Mobile session
-            filter_query = {"sessionId": request.sessionId}
-            update_data = {
-                "userId": user["_id"],
-                "sessionId": request.sessionId,
-                "preferences": request.preferences,
-                "updatedAt": datetime.utcnow()
-            }
+    # Get user by session ID
+    user = await resolve_user(request.sessionId)
+
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    # Store only the flags the client sent, as before
+    preferences = request.preferences.model_dump(exclude_unset=True)
+    now = datetime.now(timezone.utc)
+
+    # Update or create preferences
+    if request.sessionId.startswith('user_'):
+        # Clerk session
+        filter_query = {"clerkSessionId": request.sessionId}
+        update_data = {
+            "userId": user["_id"],
+            "clerkSessionId": request.sessionId,
+            "preferences": preferences,
+            "updatedAt": now
+        }
+    else:
+        # Mobile session
+        filter_query = {"sessionId": request.sessionId}
+        update_data = {
+            "userId": user["_id"],
+            "sessionId": request.sessionId,
+            "preferences": preferences,
+            "updatedAt": now
+        }
 
-        result = preferences_collection.update_one(
-            filter_query,
-            {
-                "$set": update_data,
-                "$setOnInsert": {"createdAt": datetime.utcnow()}
-            },
-            upsert=True
-        )
+    result = await preferences_collection.update_one(
+        filter_query,
+        {
+            "$set": update_data,
+            "$setOnInsert": {"createdAt": now}
+        },
+        upsert=True
+    )
+
+    return {
+        "success": True,
+        "message": "Preferences updated successfully"
+    }
 
-        return {
-            "success": True,
-            "message": "Preferences updated successfully"
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Error updating preferences: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
-    
 @router.post("/update-user-details")
-def update_user_details(request: UpdateUserDetailsRequest):
+async def update_user_details(request: UpdateUserDetailsRequest):
     """
     A generic endpoint to update a user's details based on their session ID.
     """
-    try:
-        user = get_user_by_session(request.sessionId)
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found or session invalid")
-        
-        update_data = {}
-        if request.firstName:
-            update_data["firstName"] = request.firstName
-        if request.lastName is not None:
-            update_data["lastName"] = request.lastName
-        if request.email:
-            update_data["email"] = request.email
-
-        if not update_data:
-            return {"success": True, "message": "No data to update."}
-        
-        # Determine the unique identifier for the update
-        if user.get("authProvider") == "google":
-            users_collection.update_one({"clerkSessionId": request.sessionId}, {"$set": update_data})
-        else:
-            session_record = sessions_collection.find_one({"sessionId": request.sessionId})
-            users_collection.update_one({"mobileNumber": session_record["mobileNumber"]}, {"$set": update_data})
-        
-        return {"success": True, "message": "User details updated successfully"}
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Error updating user details: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
\ No newline at end of file
+    user = await resolve_user(request.sessionId)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found or session invalid")
+
+    update_data = {}
+    if request.firstName:
+        update_data["firstName"] = request.firstName
+    if request.lastName is not None:
+        update_data["lastName"] = request.lastName
+    if request.email:
+        update_data["email"] = request.email
+
+    if not update_data:
+        return {"success": True, "message": "No data to update."}
+
+    # Determine the unique identifier for the update
+    if user.get("authProvider") == "google":
+        await users_collection.update_one({"clerkSessionId": request.sessionId}, {"$set": update_data})
+    else:
+        await users_collection.update_one({"mobileNumber": user["mobileNumber"]}, {"$set": update_data})
+
+    await resolve_user.invalidate(request.sessionId)
+
+    return {"success": True, "message": "User details updated successfully"}
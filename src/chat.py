@@ -1,33 +1,61 @@
 # backend/src/chat.py
 
-from fastapi import APIRouter, HTTPException, File, UploadFile, Form
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form, Query, Request, Response
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, TypeAdapter
+import logging
 import os
-import requests
-import base64
-from pymongo import MongoClient
+import httpx
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import CollectionInvalid, OperationFailure
 from dotenv import load_dotenv
 from datetime import datetime, timezone
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+from .api_clients import client
+from .auth import resolve_user, users_collection
+from .db import (
+    EVENTS_CAPPED_SIZE, FAST_WRITE_CONCERN, MESSAGE_INDEXES, REDUNDANT_MESSAGE_INDEXES, events_collection_name,
+)
+from .http_client import http_client
 
 # Load environment variables
 load_dotenv()
-MONGO_URI = os.getenv("MONGO_URI")
 IMGBB_API_KEY = os.getenv("IMGBB_API_KEY")
+IMGBB_UPLOAD_URL = "https://api.imgbb.com/1/upload"
+MAX_IMAGE_BYTES = 32 * 1024 * 1024  # ImgBB's own upload limit
+MAX_UPLOAD_BODY_BYTES = MAX_IMAGE_BYTES + 64 * 1024  # Room for the multipart framing and sessionId
+# Only admin CLIs in tail mode read event markers, so writing them is opt-in
+CHAT_EVENTS_ENABLED = os.getenv("CHAT_EVENTS_ENABLED", "").lower() in ("1", "true", "yes")
 
-# --- MongoDB Connection ---
-try:
-    client = MongoClient(MONGO_URI)
-    auth_db = client.mobileauth
-    users_collection = auth_db.users
-    sessions_collection = auth_db.sessions
-    chats_db = client.chats
-    print("Successfully connected to MongoDB.")
-except Exception as e:
-    print(f"Error connecting to MongoDB: {e}")
-    client = None 
+logger = logging.getLogger("chat")
+
+# --- MongoDB Collections (on the shared client from db.py) ---
+chats_db = client.chats
+messages_collection = chats_db.messages  # all chats, keyed by userId
+_events_ready = set()  # chats whose capped events collection exists
+
+class UploadSizeLimitRoute(APIRoute):
+    """Rejects uploads whose Content-Length is too large before the multipart body is read and spooled."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def limited_handler(request: Request) -> Response:
+            length = request.headers.get("content-length")
+            if length is not None and length.isdigit() and int(length) > MAX_UPLOAD_BODY_BYTES:
+                raise HTTPException(status_code=413, detail="Image is too large.")
+            return await handler(request)
+
+        return limited_handler
 
 router = APIRouter()
+upload_router = APIRouter(route_class=UploadSizeLimitRoute)
+
+# Chat history pages; older messages are fetched with ?before=<oldest timestamp>&before_id=<oldest id>
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+HISTORY_PROJECTION = {"text": 1, "timestamp": 1, "sender": 1}
 
 # --- Pydantic Models ---
 
@@ -42,101 +70,183 @@ class MessageResponse(BaseModel):
     timestamp: datetime
     isUser: bool
 
+# Validates a whole history page in one call
+MESSAGE_LIST_ADAPTER = TypeAdapter(List[MessageResponse])
+
 class StatusResponse(BaseModel):
     status: str
     message: str
 
-# --- Helper Function ---
-def find_user_by_session(session_id: str) -> Dict[str, Any] | None:
-    if not client:
-        raise HTTPException(status_code=503, detail="Database connection not available")
-    user = None
-    if session_id.startswith('user_'):
-        user = users_collection.find_one({"clerkSessionId": session_id})
-    else:
-        session_record = sessions_collection.find_one({"sessionId": session_id, "verified": True})
-        if session_record:
-            mobile_number = session_record.get("mobileNumber")
-            user = users_collection.find_one({"mobileNumber": mobile_number})
+# --- Dependencies: resolve the session's user once per request ---
+async def history_user(session_id: str) -> Dict[str, Any] | None:
+    return await resolve_user(session_id)
+
+async def message_user(request: SendMessageRequest) -> Dict[str, Any]:
+    user = await resolve_user(request.sessionId)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found for the given session.")
+    return user
+
+async def checked_image(file: UploadFile = File(...)) -> UploadFile:
+    # Rejects unconfigured or oversized uploads before any session lookup. The body is
+    # already spooled here; this catches uploads sent without a usable Content-Length.
+    if not IMGBB_API_KEY:
+        raise HTTPException(status_code=500, detail="Image upload service is not configured.")
+
+    if file.size is not None and file.size > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Image is too large.")
+    return file
+
+async def upload_user(sessionId: str = Form(...), file: UploadFile = Depends(checked_image)) -> Dict[str, Any]:
+    user = await resolve_user(sessionId)
+    if not user:
+        raise HTTPException(status_code=404, detail="User session not found.")
     return user
 
+async def ensure_chat_collections(mongo_client):
+    """Indexes the messages collection and warns about chats that still need migrating."""
+    index_chats_db = mongo_client.chats
+    for keys in MESSAGE_INDEXES:
+        await index_chats_db.messages.create_index(keys)
+    for name in REDUNDANT_MESSAGE_INDEXES:
+        try:
+            await index_chats_db.messages.drop_index(name)
+        except OperationFailure:
+            pass  # Never built or already dropped
+
+    # Per-user chat collections aren't read any more; their history only shows up once migrated
+    legacy = await index_chats_db.list_collection_names(filter={"name": {"$regex": r"^chat_[0-9a-f]{24}$"}})
+    if legacy:
+        logger.warning("%d chat_<user_id> collections found; run migrate_chats.py to move them "
+                       "into chats.messages", len(legacy))
+
+async def record_message_events(message_docs: List[Dict[str, Any]]):
+    """Appends markers for inserted messages to the chat's capped events collection for tailing admin CLIs."""
+    if not CHAT_EVENTS_ENABLED:
+        return
+    user_id = message_docs[0]["userId"]
+    name = events_collection_name(user_id)
+    if name not in _events_ready:
+        try:
+            await chats_db.create_collection(name, capped=True, size=EVENTS_CAPPED_SIZE)
+        except CollectionInvalid:
+            pass  # Already exists
+        _events_ready.add(name)
+    # Markers are cheap to lose, so they skip the journal
+    await chats_db.get_collection(name, write_concern=FAST_WRITE_CONCERN).insert_many([
+        {
+            "mid": doc["_id"],
+            "sender": doc["sender"],
+            "text": doc["text"],
+            "ts": doc["timestamp"],
+        }
+        for doc in message_docs
+    ])
+
 # --- API Endpoints ---
 
 @router.get("/chat/history/{session_id}", response_model=List[MessageResponse])
-def get_chat_history(session_id: str):
-    user = find_user_by_session(session_id)
+async def get_chat_history(limit: int = Query(HISTORY_PAGE_SIZE, ge=1), before: Optional[datetime] = None,
+                           before_id: Optional[str] = None,
+                           user: Dict[str, Any] | None = Depends(history_user)):
     if not user:
         return []
 
-    chat_collection = chats_db[f"chat_{user['_id']}"]
-    
-    messages_cursor = chat_collection.find().sort("timestamp", 1)
-    history = [
-        MessageResponse(
-            id=str(msg["_id"]),
-            text=msg["text"],
-            timestamp=msg["timestamp"],
-            isUser=msg["sender"] == "user"
-        ) for msg in messages_cursor
-    ]
-    return history
+    limit = min(limit, HISTORY_MAX_PAGE_SIZE)
+    query: Dict[str, Any] = {"userId": user["_id"]}
+    if before_id is not None:
+        if before is None:
+            raise HTTPException(status_code=422, detail="before_id requires before")
+        try:
+            before_oid = ObjectId(before_id)
+        except InvalidId:
+            raise HTTPException(status_code=422, detail="Invalid before_id")
+        # Keyset on (timestamp, _id), so messages sharing the boundary timestamp aren't skipped
+        query["$or"] = [
+            {"timestamp": {"$lt": before}},
+            {"timestamp": before, "_id": {"$lt": before_oid}},
+        ]
+    elif before is not None:
+        query["timestamp"] = {"$lt": before}
+
+    # Newest page first so the limit applies server-side, then back to chronological order
+    messages = await messages_collection.find(query, HISTORY_PROJECTION) \
+        .sort([("timestamp", -1), ("_id", -1)]).limit(limit).to_list(length=limit)
+    messages.reverse()
+
+    return MESSAGE_LIST_ADAPTER.validate_python([
+        {
+            "id": str(msg["_id"]),
+            "text": msg["text"],
+            "timestamp": msg["timestamp"],
+            "isUser": msg["sender"] == "user"
+        } for msg in messages
+    ])
 
 # FIX: Use the new SendMessageRequest model as the type hint
 @router.post("/chat/send-message", response_model=StatusResponse)
-def send_message(request: SendMessageRequest):
-    if not client:
-        raise HTTPException(status_code=503, detail="Database not connected")
-    
-    user = find_user_by_session(request.sessionId)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found for the given session.")
-
-    chat_collection = chats_db[f"chat_{user['_id']}"]
-
-    user_message_doc = {"text": request.text, "sender": "user", "timestamp": datetime.now(timezone.utc)}
-    chat_collection.insert_one(user_message_doc)
-
-    if chat_collection.count_documents({"sender": "user"}) == 1:
+async def send_message(request: SendMessageRequest, user: Dict[str, Any] = Depends(message_user)):
+
+    # Only the request that flips welcomeSent can owe a welcome, so this is O(1) per message
+    claimed = await users_collection.update_one(
+        {"_id": user["_id"], "welcomeSent": {"$ne": True}},
+        {"$set": {"welcomeSent": True}}
+    )
+    # Users who chatted before the flag existed already got their welcome
+    send_welcome = claimed.modified_count == 1 and await messages_collection.find_one(
+        {"userId": user["_id"], "sender": "user"}, {"_id": 1}
+    ) is None
+
+    now = datetime.now(timezone.utc)
+    user_message_doc = {
+        "userId": user["_id"],
+        "text": request.text,
+        "sender": "user",
+        "timestamp": now
+    }
+    docs = [user_message_doc]
+
+    if send_welcome:
         bot_welcome_text = "Thank you for contacting support! An agent will be with you shortly."
-        bot_message_doc = {"text": bot_welcome_text, "sender": "bot", "timestamp": datetime.now(timezone.utc)}
-        chat_collection.insert_one(bot_message_doc)
+        docs.append({
+            "userId": user["_id"],
+            "text": bot_welcome_text,
+            "sender": "bot",
+            "timestamp": now
+        })
+
+    # insert_many fills in each doc's _id
+    await messages_collection.insert_many(docs, ordered=False)
+    await record_message_events(docs)
+
+    if send_welcome:
         return StatusResponse(status="ok", message="First message received and bot replied.")
-
     return StatusResponse(status="ok", message="Message received.")
 
 
-@router.post("/chat/upload-image", response_model=StatusResponse)
-async def upload_image(sessionId: str = Form(...), file: UploadFile = File(...)):
-    if not IMGBB_API_KEY:
-        raise HTTPException(status_code=500, detail="Image upload service is not configured.")
-
-    user = find_user_by_session(sessionId)
-    if not user:
-        raise HTTPException(status_code=404, detail="User session not found.")
-
+@upload_router.post("/chat/upload-image", response_model=StatusResponse)
+async def upload_image(file: UploadFile = Depends(checked_image), user: Dict[str, Any] = Depends(upload_user)):
     try:
-        contents = await file.read()
-        base64_image = base64.b64encode(contents).decode('utf-8')
-
-        response = requests.post(
-            "https://api.imgbb.com/1/upload",
-            data={"key": IMGBB_API_KEY, "image": base64_image}
+        # Multipart straight from the spooled upload; no in-memory copy or base64 string
+        response = await http_client.post(
+            IMGBB_UPLOAD_URL,
+            data={"key": IMGBB_API_KEY},
+            files={"image": (file.filename, file.file, file.content_type)}
         )
         response.raise_for_status()
-        
         image_url = response.json()["data"]["url"]
+    except (httpx.HTTPError, ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=502, detail="Failed to upload image to hosting service.")
 
-        chat_collection = chats_db[f"chat_{user['_id']}"]
-        image_message_doc = {
-            "text": image_url,
-            "sender": "user",
-            "timestamp": datetime.now(timezone.utc)
-        }
-        chat_collection.insert_one(image_message_doc)
+    image_message_doc = {
+        "userId": user["_id"],
+        "text": image_url,
+        "sender": "user",
+        "timestamp": datetime.now(timezone.utc)
+    }
+    await messages_collection.insert_one(image_message_doc)
+    await record_message_events([image_message_doc])
 
-        return StatusResponse(status="ok", message="Image uploaded successfully.")
+    return StatusResponse(status="ok", message="Image uploaded successfully.")
 
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=502, detail="Failed to upload image to hosting service.")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="An internal error occurred during image upload.")
+router.include_router(upload_router)
@@ -0,0 +1,51 @@
+# backend/src/db.py
+
+# Connection settings and chat schema shared by the API, the admin CLI and scripts.
+# The API's own clients live in api_clients.py so the blocking tools never build them.
+
+import os
+from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI")
+
+# Shared by the API's async client and the CLI's blocking one; compression
+# shrinks the repeated chat payloads on the wire
+CLIENT_OPTIONS = {
+    "compressors": "zstd,snappy",
+    "retryWrites": True,
+    # Fail fast when Mongo is unreachable instead of waiting out the 30 s defaults
+    "serverSelectionTimeoutMS": 2000,
+    "connectTimeoutMS": 2000,
+}
+
+# For writes that are cheap to lose or redo (default preferences, listener
+# event markers); everything else keeps the server's default write concern.
+# Apply per collection with .with_options(write_concern=FAST_WRITE_CONCERN).
+FAST_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+# Indexes on chats.messages, created by both the API and the admin CLI.
+# _id breaks timestamp ties, e.g. a first message and the bot welcome written together;
+# the sender index covers the per-sender lookups in send_message.
+MESSAGE_INDEXES = [
+    [("userId", 1), ("timestamp", 1), ("_id", 1)],
+    [("userId", 1), ("sender", 1), ("timestamp", 1)],
+]
+# Prefix of the first index above, so it only slows down inserts
+REDUNDANT_MESSAGE_INDEXES = ["userId_1_timestamp_1"]
+
+# Per-chat capped collections of message markers, followed by admin CLIs in tail mode
+EVENTS_CAPPED_SIZE = 1 << 20
+
+def events_collection_name(user_id) -> str:
+    return f"chat_{user_id}_events"
+
+
+def sync_client() -> MongoClient:
+    """
+    Blocking client for scripts such as the admin CLI
+    """
+    return MongoClient(MONGO_URI, **CLIENT_OPTIONS)
@@ -0,0 +1,10 @@
+# backend/src/http_client.py
+
+import httpx
+
+# Shared keep-alive client for outbound calls (2factor.in, ImgBB); closed by the app lifespan in main.py
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(connect=2.0, read=5.0, write=5.0, pool=5.0),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=32),
+)
@@ -0,0 +1,22 @@
+# backend/src/logging_setup.py
+
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Request handlers only enqueue records; the listener thread formats and writes them to stderr.
+# main.py's lifespan starts and stops log_listener.
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, _stream_handler)
+
+# Records queued before the lifespan starts the listener are written once it does
+for _name in ("app", "auth", "chat"):
+    _logger = logging.getLogger(_name)
+    _logger.setLevel(LOG_LEVEL)
+    _logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _logger.propagate = False
@@ -0,0 +1,150 @@
+# backend/src/session_lookup.py
+
+import threading
+from bson import json_util
+from redis.exceptions import RedisError
+from typing import Optional, Dict, Any
+
+
+def find_user_by_session(users_collection, sessions_collection, session_id: str,
+                         projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Finds a user by session ID (handles both mobile and clerk sessions)
+    """
+    if session_id.startswith('user_'):
+        # Clerk session ID
+        return users_collection.find_one({"clerkSessionId": session_id}, projection)
+
+    # Mobile session ID - first find the session, then the user
+    session_record = sessions_collection.find_one(
+        {"sessionId": session_id, "verified": True},
+        {"mobileNumber": 1}
+    )
+    if not session_record:
+        return None
+    return users_collection.find_one({"mobileNumber": session_record.get("mobileNumber")}, projection)
+
+
+async def find_user_by_session_async(users_collection, sessions_collection, session_id: str,
+                                     projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Same as find_user_by_session, for Motor collections.
+    Mobile sessions are joined to their user server-side, in one round trip.
+    """
+    if session_id.startswith('user_'):
+        return await users_collection.find_one({"clerkSessionId": session_id}, projection)
+
+    pipeline = [
+        {"$match": {"sessionId": session_id, "verified": True}},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": users_collection.name,
+            "localField": "mobileNumber",
+            "foreignField": "mobileNumber",
+            "as": "user",
+        }},
+        {"$unwind": "$user"},
+        {"$replaceRoot": {"newRoot": "$user"}},
+        {"$limit": 1},
+    ]
+    if projection:
+        pipeline.append({"$project": projection})
+    users = await sessions_collection.aggregate(pipeline).to_list(length=1)
+    return users[0] if users else None
+
+
+class SessionResolver:
+    """
+    Caches find_user_by_session results in the given cachetools cache.
+    Misses aren't cached, so a session verified later resolves on the next call.
+    """
+
+    def __init__(self, users_collection, sessions_collection, cache,
+                 projection: Optional[Dict[str, Any]] = None):
+        self.users_collection = users_collection
+        self.sessions_collection = sessions_collection
+        self.projection = projection
+        self._cache = cache
+        self._lock = threading.Lock()
+
+    def __call__(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            user = self._cache.get(session_id)
+        if user is not None:
+            return user
+
+        user = find_user_by_session(self.users_collection, self.sessions_collection, session_id, self.projection)
+        if user is not None:
+            with self._lock:
+                self._cache[session_id] = user
+        return user
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._cache.pop(session_id, None)
+
+
+class AsyncSessionResolver:
+    """
+    SessionResolver for Motor collections; await the call and invalidate().
+    With a redis client, hits are shared across workers for redis_ttl seconds.
+    invalidate() only clears this worker's cache and Redis, so other workers can
+    keep serving a replaced session from their local cache until it expires;
+    keep the local TTL short when running several workers.
+    """
+
+    def __init__(self, users_collection, sessions_collection, cache,
+                 projection: Optional[Dict[str, Any]] = None, redis=None, redis_ttl: int = 300):
+        self.users_collection = users_collection
+        self.sessions_collection = sessions_collection
+        self.projection = projection
+        self.redis = redis
+        self.redis_ttl = redis_ttl
+        self._cache = cache
+        self._lock = threading.Lock()
+
+    async def __call__(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            user = self._cache.get(session_id)
+        if user is not None:
+            return user
+
+        user = await self._redis_get(session_id)
+        if user is None:
+            user = await find_user_by_session_async(
+                self.users_collection, self.sessions_collection, session_id, self.projection
+            )
+            if user is None:
+                return None
+            await self._redis_set(session_id, user)
+
+        with self._lock:
+            self._cache[session_id] = user
+        return user
+
+    async def invalidate(self, session_id: str):
+        with self._lock:
+            self._cache.pop(session_id, None)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.delete(f"sess:{session_id}")
+        except RedisError:
+            pass  # Entry expires on its own
+
+    async def _redis_get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        if self.redis is None:
+            return None
+        try:
+            cached = await self.redis.get(f"sess:{session_id}")
+        except RedisError:
+            return None  # Fall back to Mongo
+        return json_util.loads(cached) if cached else None
+
+    async def _redis_set(self, session_id: str, user: Dict[str, Any]):
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(f"sess:{session_id}", json_util.dumps(user), ex=self.redis_ttl)
+        except RedisError:
+            pass